@@ -15,13 +15,27 @@
 #     See the License for the specific language governing permissions and
 #     limitations under the License.
 
-from contextlib import contextmanager
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import suppress
+from operator import itemgetter
 
 import argparse
+import asyncio
+import csv
+import functools
 import json
 import os
-import subprocess
+import re
+import sys
+
+# optional faster json decoders for parsing confs, all of them accept the raw bytes of the file
+try:
+    import orjson as fast_json
+except ImportError:
+    try:
+        import ujson as fast_json
+    except ImportError:
+        fast_json = json
 
 
 CWD = os.getcwd()
@@ -94,49 +108,95 @@ ORANGE = '\033[38;5;130m'
 BLUE = '\033[38;5;27m'
 GREY = '\033[38;5;246m'
 HIGHLIGHT = BOLD+ITALIC+RED
+# line templates for prettify_entry with the color codes baked in
+LINE_FMT = f"{BOLD}{ORANGE}%15s{NORMAL} - %s"
+FILE_FMT = f"{BOLD}%s %s{NORMAL}"
+TRUNCATED_FMT = f"[%s ... {GREY}{UNDERLINE}%d more{NORMAL}]"
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_path(json_path):
+    """
+    Splits a dotted json path once into a tuple of (key, is_array) steps.
+    """
+    steps = []
+    for key in json_path.split("."):
+        is_array = key.endswith("[]")
+        steps.append((key[:-2] if is_array else key, is_array))
+    return tuple(steps)
+
+
+def compile_index_spec(index_spec):
+    return {column: tuple(_compile_path(path) for path in paths) for column, paths in index_spec.items()}
+
+
+_GB_INDEX_COMPILED = compile_index_spec(GB_INDEX_SPEC)
+_JOIN_INDEX_COMPILED = compile_index_spec(JOIN_INDEX_SPEC)
+
+
+def _compiled_spec(index_spec):
+    if index_spec is GB_INDEX_SPEC:
+        return _GB_INDEX_COMPILED
+    if index_spec is JOIN_INDEX_SPEC:
+        return _JOIN_INDEX_COMPILED
+    return compile_index_spec(index_spec)
+
+
+# walks the json nodes collecting all values that match the compiled path steps, with an explicit stack
+# instead of recursion. an `is_array` step indicates that there is an array of object in the correspoding node value.
+def extract_json_compiled(steps, conf_json):
+    result = []
+    last = len(steps)
+    stack = [(0, conf_json)]
+    while stack:
+        idx, node = stack.pop()
+        if idx == last:
+            if steps[-1][1] or isinstance(node, list):
+                result.extend(node)
+            else:
+                result.append(node)
+            continue
+        key, is_array = steps[idx]
+        if key in node:
+            if is_array:
+                # reversed so that values are popped, and collected, in document order
+                stack.extend((idx + 1, value) for value in reversed(node[key]))
+            else:
+                stack.append((idx + 1, node[key]))
+    return result
 
 
-# walks the json nodes recursively collecting all values that match the path
 # a trailing `[]` in a field in the path indicates that there is an array of
 # object in the correspoding node value.
 def extract_json(json_path, conf_json):
     if json_path is None:
         return conf_json
-    steps = json_path.split(".", 1)
-    key = steps[0]
-    next = steps[1] if len(steps) > 1 else None
-    if key.endswith("[]"):
-        key = key[:-2]
-        if key in conf_json:
-            result = []
-            for value in conf_json[key]:
-                result.extend(extract_json(next, value))
-            return result
-    else:
-        if key in conf_json:
-            final = extract_json(next, conf_json[key])
-            if isinstance(final, list):
-                return final
-            else:
-                return [final]
-    return []
+    return extract_json_compiled(_compile_path(json_path), conf_json)
+
 
+# many confs share the same python module, so existence checks are memoized
+@functools.lru_cache(maxsize=None)
+def _exists(path):
+    return os.path.exists(path)
 
-def build_entry(conf, index_spec, conf_type, root=CWD, teams=None):
+
+def build_entry(conf, index_spec, conf_type, root=CWD, teams=None, compiled_spec=None):
     conf_dict = conf
     if isinstance(conf, str):
-        with open(conf) as conf_file:
+        with open(conf, "rb") as conf_file:
             try:
-                conf_dict = json.load(conf_file)
+                conf_dict = fast_json.loads(conf_file.read())
             except BaseException as ex:
                 print(f"Failed to parse {conf} due to :: {ex}")
                 return
+    # extracted columns are never mutated after this, so they are stored as compact tuples.
+    # searchable columns are deduped once here (preserving order) instead of on every display.
     entry = {"file": None}
-    for column, paths in index_spec.items():
+    for column, compiled_paths in (compiled_spec or _compiled_spec(index_spec)).items():
         result = []
-        for path in paths:
-            result.extend(extract_json(path, conf_dict))
-        entry[column] = result
+        for steps in compiled_paths:
+            result.extend(extract_json_compiled(steps, conf_dict))
+        entry[column] = tuple(dict.fromkeys(result)) if column in FILTER_COLUMNS else tuple(result)
 
     if len(entry["name"]) == 0:
         return None
@@ -146,140 +206,196 @@ def build_entry(conf, index_spec, conf_type, root=CWD, teams=None):
     # Update missing values with teams defaults.
     for field, mapped_field in DEFAULTS_SPEC.items():
         if field in entry and not entry[field]:
-            entry[field] = [teams[team][mapped_field]]
+            entry[field] = (teams[team][mapped_field],)
 
     file_base = "/".join(conf_module.split(".")[:-1])
-    py_file = file_base + ".py"
-    init_file = file_base + "/__init__.py"
-    py_path = os.path.join(root, conf_type, team, py_file)
-    init_path = os.path.join(root, conf_type, team, init_file)
-    conf_path = py_path if os.path.exists(py_path) else init_path
+    py_path = os.path.join(root, conf_type, team, file_base + ".py")
+    conf_path = py_path if _exists(py_path) else os.path.join(root, conf_type, team, file_base + "/__init__.py")
     entry["json_file"] = os.path.join(root, "production", conf_type, team, conf_module)
     entry["file"] = conf_path
     return entry
 
 
-@contextmanager
-def chdir(path):
-    """
-    Context manager to run subprocesses in the appropriate folder so git can get the relevant info.
-    """
-    origin = Path().absolute()
-    try:
-        os.chdir(path)
-        yield
-    finally:
-        os.chdir(origin)
+git_info_cache = {}
+# keep each `git log` command line comfortably below ARG_MAX
+GIT_LOG_PATHS_PER_CALL = 1000
+
+
+async def _git_log_chunk(rel_paths, exclude_args, root, semaphore):
+    commits = {}
+    pending = set(rel_paths)
+    # -c lists the files a merge changed relative to every parent (e.g. conflict resolutions),
+    # which `--name-only` alone omits, so merges are credited like in a per-file `git log`
+    args = ["log", "-c", "--relative", "--name-only", "--pretty=format:%x00%as/%an/%ae", *exclude_args, "--",
+            *rel_paths]
+    async with semaphore:
+        proc = await asyncio.create_subprocess_exec(
+            "git", *args, cwd=root, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        commit = None
+        async for raw_line in proc.stdout:
+            line = raw_line.decode("utf-8").rstrip("\n")
+            if line.startswith("\x00"):
+                commit = line[1:]
+            elif line and line in pending:
+                # equivalent of `git log -n 2` per file
+                found = commits.setdefault(line, [])
+                found.append(commit)
+                if len(found) == 2:
+                    pending.discard(line)
+                    if not pending:
+                        # everything is resolved, no need to walk the rest of the history
+                        with suppress(ProcessLookupError):
+                            proc.kill()
+                        break
+        await proc.wait()
+    return commits
+
+
+async def _git_log_chunks(rel_paths, exclude_args, root):
+    semaphore = asyncio.Semaphore((os.cpu_count() or 1) * 2)
+    chunks = [
+        rel_paths[start:start + GIT_LOG_PATHS_PER_CALL]
+        for start in range(0, len(rel_paths), GIT_LOG_PATHS_PER_CALL)
+    ]
+    results = await asyncio.gather(*[_git_log_chunk(chunk, exclude_args, root, semaphore) for chunk in chunks])
+    commits = {}
+    for result in results:
+        commits.update(result)
+    return commits
 
 
-git_info_cache = {}
+def build_git_map(file_paths, exclude=None, root=CWD):
+    """
+    Collect the last two commits touching each of the file paths with a single streaming `git log` pass
+    per chunk of paths instead of one process per file. Chunks run concurrently, bounded by a semaphore.
+    Returns {file_path: formatted commit info}.
+    """
+    exclude_args = ["--invert-grep", f"--grep={exclude}"] if exclude else []
+    rel_to_path = {os.path.relpath(file_path, root): file_path for file_path in file_paths}
+    rel_paths = list(rel_to_path)
+    commits = asyncio.run(_git_log_chunks(rel_paths, exclude_args, root)) if rel_paths else {}
+    return {
+        rel_to_path[rel_path]: " ".join(f"{BLUE} {commit}" for commit in commits.get(rel_path, []))
+        for rel_path in rel_paths
+    }
 
 
-# git_info is the most expensive part of the entire script - so we will have to parallelize
+# git_info is the most expensive part of the entire script - so it is resolved in one batched `git log` pass
 def git_info(file_paths, exclude=None, root=CWD):
-    exclude_args = f"--invert-grep --grep={exclude}" if exclude else ''
-    procs = []
-    with chdir(root):
-        for file_path in file_paths:
-            if file_path in git_info_cache:
-                procs.append((file_path, git_info_cache[file_path]))
-            else:
-                args = (
-                    f"echo $(git log -n 2 --pretty='format:{BLUE} %as/%an/%ae' {exclude_args} -- "
-                    f"{file_path.replace(root, '')})")
-                procs.append((file_path, subprocess.Popen(args, stdout=subprocess.PIPE, shell=True)))
-
-        result = {}
-        for file_path, proc in procs:
-            if isinstance(proc, subprocess.Popen):
-                lines = []
-                for line in proc.stdout.readlines():
-                    lines.append(line.decode("utf-8").strip())
-                git_info_cache[file_path] = lines[0]
-            result[file_path] = git_info_cache[file_path]
-    return result
+    missing = [file_path for file_path in file_paths if file_path not in git_info_cache]
+    if missing:
+        git_info_cache.update(build_git_map(missing, exclude=exclude, root=root))
+    return {file_path: git_info_cache[file_path] for file_path in file_paths}
 
 
+# iterative walk over os.scandir, which reuses the file type from readdir instead of stat-ing every entry.
+# yields plain paths as DirEntry objects can't be shipped to the parsing worker processes.
 def walk_files(path):
-    for root, _, files in os.walk(path):
-        for file in files:
-            yield os.path.join(root, file)
+    dirs = [path]
+    while dirs:
+        try:
+            with os.scandir(dirs.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            dirs.append(entry.path)
+                    else:
+                        yield entry.path
+        except OSError:
+            continue
+
+
+# parsing and extraction of each conf is independent, so it is spread across cores.
+# threads are the fallback on platforms where a process pool can't be created.
+def _parse_executor():
+    try:
+        return ProcessPoolExecutor(max_workers=os.cpu_count())
+    except (ImportError, NotImplementedError, OSError):
+        return ThreadPoolExecutor(max_workers=os.cpu_count())
 
 
 def build_index(conf_type, index_spec, root=CWD, teams=None):
     rel_path = os.path.join(root, "production", conf_type)
     teams = teams or {}
     index_table = {}
-    for path in walk_files(rel_path):
-        index_entry = build_entry(path, index_spec, conf_type, root=root, teams=teams)
-        if index_entry is not None:
-            index_table[index_entry["name"][0]] = index_entry
+    paths = list(walk_files(rel_path))
+    # resolved here as the spec reaching the workers is a pickled copy that no longer matches by identity
+    parse = functools.partial(
+        build_entry, index_spec=index_spec, conf_type=conf_type, root=root, teams=teams,
+        compiled_spec=_compiled_spec(index_spec))
+    with _parse_executor() as executor:
+        for index_entry in executor.map(parse, paths, chunksize=32):
+            if index_entry is not None:
+                index_table[index_entry["name"][0]] = index_entry
     return index_table
 
 
-def find_string(text, word):
-    start = text.find(word)
-    while start > -1:
-        yield start
-        start = text.find(word, start + 1)
+def find_string(text, word, pattern=None):
+    pattern = pattern or re.compile(re.escape(word))
+    for match in pattern.finditer(text):
+        yield match.start()
 
 
-def highlight(text, word):
-    result = ""
-    prev_idx = 0
-    for idx in find_string(text, word):
-        result = result + text[prev_idx:idx] + HIGHLIGHT + word + NORMAL
-        prev_idx = idx + len(word)
-    result += text[prev_idx:len(text)]
-    return result
+def highlight(text, word, pattern=None):
+    pattern = pattern or re.compile(re.escape(word))
+    highlighted = HIGHLIGHT + word + NORMAL
+    return pattern.sub(lambda _: highlighted, text)
+
+
+# renders column values for display independently of how the index stores them
+def format_values(values):
+    if isinstance(values, (list, tuple)):
+        return "[" + ", ".join(map(repr, values)) + "]"
+    return str(values)
 
 
-def prettify_entry(entry, target, modification, show=10, root=CWD, trim_paths=False):
+def prettify_entry(entry, target, modification, show=10, root=CWD, trim_paths=False, pattern=None):
     lines = []
     if trim_paths:
         for field in filter(lambda x: x in entry, PATH_FIELDS):
             entry[field] = entry[field].replace(root, '')
     for column, values in entry.items():
-        name = " "*(15 - len(column)) + column
         if column in FILTER_COLUMNS and len(values) > show:
-            values = [value for value in set(values) if target in value]
+            values = [value for value in values if target in value]
             if (len(values) > show):
-                truncated = ', '.join(values[:show])
-                remaining = len(values) - show
-                values = f"[{truncated} ... {GREY}{UNDERLINE}{remaining} more{NORMAL}]"
+                values = TRUNCATED_FMT % (', '.join(values[:show]), len(values) - show)
         if column == "file":
-            values = f"{BOLD}{values} {modification}{NORMAL}"
+            values = FILE_FMT % (values, modification)
         else:
-            values = highlight(str(values), target)
-        lines.append(f"{BOLD}{ORANGE}{name}{NORMAL} - {values}")
+            values = highlight(format_values(values), target, pattern)
+        lines.append(LINE_FMT % (column, values))
     content = "\n" + "\n".join(lines)
     return content
 
 
 def find_in_index(index_table, target):
     def valid_entry(entry):
-        return any([
-            target in value
-            for column, values in entry.items()
-            if column in FILTER_COLUMNS
-            for value in values
-        ])
+        for column in FILTER_COLUMNS:
+            for value in entry.get(column, ()):
+                if target in value:
+                    return True
+        return False
     return find_in_index_pred(index_table, valid_entry)
 
 
 def find_in_index_pred(index_table, valid_entry):
-    return [entry for _, entry in index_table.items() if valid_entry(entry)]
+    return [entry for entry in index_table.values() if valid_entry(entry)]
 
 
 def display_entries(entries, target, root=CWD, trim_paths=False):
     git_infos = git_info([entry["file"] for entry in entries], root=root)
+    pattern = re.compile(re.escape(target))
     display = []
     for entry in entries:
         info = git_infos[entry["file"]]
-        pretty = prettify_entry(entry, target, info, root=root, trim_paths=trim_paths)
-        display.append((info, pretty))
-
-    for (_, pretty_entry) in sorted(display):
+        pretty = prettify_entry(entry, target, info, root=root, trim_paths=trim_paths, pattern=pattern)
+        # order by the date of the latest commit (skipping the color code), then by file,
+        # without comparing the long highlighted text.
+        date = info[len(BLUE) + 1:len(BLUE) + 11]
+        display.append(((date, entry["file"]), pretty))
+
+    display.sort(key=itemgetter(0))
+    for (_, pretty_entry) in display:
         print(pretty_entry)
 
 
@@ -294,9 +410,11 @@ def enrich_with_joins(gb_index, join_index, root=CWD, teams=None):
         group_by["joins"] = []
         group_by["join_event_driver"] = []
     for _, join in join_index.items():
+        join_name = join["name"][0]
         for gb_name in join["group_bys"]:
-            if gb_name in gb_index:
-                gb_index[gb_name]["joins"].append(join["name"][0])
+            # a join can reference the same group by more than once, record it only the first time
+            if gb_name in gb_index and join_name not in gb_index[gb_name]["joins"]:
+                gb_index[gb_name]["joins"].append(join_name)
                 if len(join["_events_driver"]) > 0:
                     gb_index[gb_name]["join_event_driver"].append(join["_events_driver"][0])
 
@@ -309,15 +427,32 @@ gb_index = []
 join_index = []
 
 
+def split_author(auth_str):
+    name_email = auth_str.split("/")[-2:]
+    return name_email if len(name_email) == 2 else ["", ""]
+
+
 def author_name_email(file, exclude=None):
-    if not os.path.exists(file):
+    if not _exists(file):
         return ("", "")
     if file not in file_to_author:
         for file, auth_str in git_info([file], exclude).items():
-            file_to_author[file] = auth_str.split("/")[-2:]
+            file_to_author[file] = split_author(auth_str)
     return file_to_author[file]
 
 
+def prefetch_authors(files, exclude=None):
+    """
+    Resolves the authors of all the files with one batched `git log` pass so that
+    the following author_name_email calls are served from file_to_author.
+    """
+    missing = [file for file in files if file not in file_to_author and _exists(file)]
+    if missing:
+        for file, auth_str in build_git_map(missing, exclude=exclude).items():
+            file_to_author[file] = split_author(auth_str)
+
+
+@functools.lru_cache(maxsize=None)
 def conf_file(conf_type, conf_name):
     path_parts = ["production", conf_type]
     path_parts.extend(conf_name.split(".", 1))
@@ -330,41 +465,46 @@ def events_without_topics(output_file=None, exclude_commit_message=None):
     result = []
     emails = set()
 
+    def producer_file(entry):
+        return entry["json_file"] if _exists(entry["json_file"]) else entry["file"]
+
     def is_events_without_topics(entry):
-        found = len(entry["_event_topics"]) == 0 and len(entry["_event_tables"]) > 0
+        return len(entry["_event_topics"]) == 0 and len(entry["_event_tables"]) > 0
+
+    found = find_in_index_pred(gb_index, is_events_without_topics)
+    files = set()
+    for entry in found:
+        files.add(producer_file(entry))
+        files.update(conf_file("joins", join) for join in entry["joins"])
+    prefetch_authors(files, exclude_commit_message)
+
+    for entry in found:
         is_online = len(entry["online"]) > 0
         joins = ", ".join(entry["joins"]) if len(entry["joins"]) > 0 else "STANDALONE"
-        if found:
-            file = entry["json_file"] if os.path.exists(entry["json_file"]) else entry["file"]
-            producer_name, producer_email = author_name_email(file, exclude_commit_message)
-            emails.add(producer_email)
-            consumers = set()
-            for join in entry["joins"]:
-                conf_file_path = conf_file("joins", join)
-                consumer_name, consumer_email = author_name_email(conf_file_path, exclude_commit_message)
-                consumers.add(consumer_name)
-                emails.add(consumer_email)
-            row = [
-                entry["name"][0],
-                producer_name,
-                is_online,
-                entry["_event_tables"][0],
-                joins,
-                ", ".join(consumers)
-            ]
-            result.append(row)
-        return found
-
-    find_in_index_pred(gb_index, is_events_without_topics)
+        producer_name, producer_email = author_name_email(producer_file(entry), exclude_commit_message)
+        emails.add(producer_email)
+        consumers = set()
+        for join in entry["joins"]:
+            consumer_name, consumer_email = author_name_email(conf_file("joins", join), exclude_commit_message)
+            consumers.add(consumer_name)
+            emails.add(consumer_email)
+        row = [
+            entry["name"][0],
+            producer_name,
+            is_online,
+            entry["_event_tables"][0],
+            joins,
+            ", ".join(consumers)
+        ]
+        result.append(row)
+
     if output_file:
-        with open(os.path.expanduser(output_file), 'w') as tsv_file:
-            for row in result:
-                tsv_file.write('\t'.join(map(str, row))+'\n')
+        with open(os.path.expanduser(output_file), 'w', buffering=1 << 20, newline='') as tsv_file:
+            csv.writer(tsv_file, delimiter='\t', lineterminator='\n').writerows(result)
         print("wrote information about cases where events us used " +
               f"without topics set into file {os.path.expanduser(output_file)}")
     else:
-        for row in result:
-            print('\t'.join(map(str, row))+'\n')
+        csv.writer(sys.stdout, delimiter='\t', lineterminator='\n').writerows(result)
     print(",".join(list(emails)))
 
 
@@ -4,22 +4,48 @@ import airflow_client
 from ai.chronon.scheduler.interfaces.orchestrator import WorkflowOrchestrator
 
 from airflow import DAG
-from airflow.operators.bash_operator import BashOperator
+from airflow.operators.bash import BashOperator
 
 AIRFLOW_CLUSTER = airflow_client.Service.STONE
+# clusters airflow_client has already been initialized against
+_initialized_clusters = set()
+
+
+def topological_order(deps_idx):
+    """
+    Kahn's algorithm over node indices, deps_idx[i] holds the indices of the nodes that node i depends on.
+    """
+    dependents = [[] for _ in deps_idx]
+    pending = [len(deps) for deps in deps_idx]
+    for idx, deps in enumerate(deps_idx):
+        for dep in deps:
+            dependents[dep].append(idx)
+    order = [idx for idx, count in enumerate(pending) if count == 0]
+    head = 0
+    while head < len(order):
+        for dependent in dependents[order[head]]:
+            pending[dependent] -= 1
+            if pending[dependent] == 0:
+                order.append(dependent)
+        head += 1
+    if len(order) != len(deps_idx):
+        raise ValueError("Flow dependencies contain a cycle")
+    return order
 
 
 class AirflowAdapter(WorkflowOrchestrator):
     def __init__(self, dag_id, start_date, schedule_interval="@once", airflow_cluster=AIRFLOW_CLUSTER):
         self.dag = DAG(
             dag_id,
-            start_date=datetime.strptime(start_date, "%Y-%m-%d"),
+            start_date=datetime.fromisoformat(start_date),
             schedule_interval=schedule_interval,
         )
         self.airflow_cluster = airflow_cluster
 
     def setup(self):
-        airflow_client.init(self.airflow_cluster)
+        if self.airflow_cluster not in _initialized_clusters:
+            airflow_client.init(self.airflow_cluster)
+            _initialized_clusters.add(self.airflow_cluster)
 
     def schedule_task(self, node):
         return BashOperator(task_id=node.name, dag=self.dag, bash_command=node.command)
@@ -28,12 +54,14 @@ class AirflowAdapter(WorkflowOrchestrator):
         task.set_upstream(dependencies)
 
     def build_dag_from_flow(self, flow):
-        node_to_task = {node.name: self.schedule_task(node) for node in flow.nodes}
-        for node in flow.nodes:
-            task = node_to_task[node.name]
-            for dep in node.dependencies:
-                dep_task = node_to_task[dep.name]
-                self.set_dependencies(task, dep_task)
+        name_to_idx = {node.name: idx for idx, node in enumerate(flow.nodes)}
+        deps_idx = [[name_to_idx[dep.name] for dep in node.dependencies] for node in flow.nodes]
+        tasks = [None] * len(flow.nodes)
+        # upstream tasks always exist by the time a task is created and wired
+        for idx in topological_order(deps_idx):
+            tasks[idx] = self.schedule_task(flow.nodes[idx])
+            if deps_idx[idx]:
+                self.set_dependencies(tasks[idx], [tasks[dep] for dep in deps_idx[idx]])
         return self.dag
 
     def trigger_run(self):
@@ -16,18 +16,23 @@ Run the flow for materialize.
 #     See the License for the specific language governing permissions and
 #     limitations under the License.
 
+from ai.chronon.repo import explore
 from ai.chronon.repo.explore import (
     load_team_data,
     build_index,
     enrich_with_joins,
     display_entries,
     find_in_index,
+    build_git_map,
+    extract_json,
     GB_INDEX_SPEC,
     JOIN_INDEX_SPEC,
+    BLUE,
 )
 
 import pytest
 import os
+import subprocess
 
 
 @pytest.mark.parametrize("keyword", ["event", "entity"])
@@ -40,3 +45,74 @@ def test_basic_flow(teams_json, rootdir, keyword):
     group_bys = find_in_index(gb_index, keyword)
     display_entries(group_bys, keyword, root=root, trim_paths=True)
     assert len(group_bys) > 0
+
+
+def test_extract_json():
+    conf = {
+        "sources": [{"events": {"table": "a"}}, {"entities": {"snapshotTable": "b"}}, {"events": {"table": "c"}}],
+        "keyColumns": ["k1", "k2"],
+    }
+    assert extract_json("sources[].events.table", conf) == ["a", "c"]
+    assert extract_json("keyColumns", conf) == ["k1", "k2"]
+    assert extract_json("metaData.name", conf) == []
+
+
+def _git(repo, *args, author="author", check=True):
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_NAME=author, GIT_AUTHOR_EMAIL=f"{author}@example.com",
+        GIT_COMMITTER_NAME=author, GIT_COMMITTER_EMAIL=f"{author}@example.com",
+    )
+    return subprocess.run(["git", *args], cwd=repo, env=env, check=check, capture_output=True, text=True).stdout
+
+
+def _commit(repo, files, message, author):
+    for name in files:
+        with open(os.path.join(repo, name), "a") as f:
+            f.write(message + "\n")
+    _git(repo, "add", *files, author=author)
+    _git(repo, "commit", "-m", message, author=author)
+
+
+def _git_log_n2(repo, path, exclude=None):
+    exclude_args = ["--invert-grep", f"--grep={exclude}"] if exclude else []
+    lines = _git(repo, "log", "-n", "2", "--pretty=format:%as/%an/%ae", *exclude_args, "--", path).splitlines()
+    return " ".join(f"{BLUE} {line}" for line in lines)
+
+
+@pytest.fixture
+def git_repo(tmp_path):
+    repo = str(tmp_path)
+    _git(repo, "init", "-q")
+    _commit(repo, ["often.py", "twice.py", "once.py", "merged.py"], "first", "alice")
+    _commit(repo, ["often.py", "twice.py"], "second", "bob")
+    _commit(repo, ["often.py"], "skip me", "carol")
+    _commit(repo, ["often.py"], "fourth", "dave")
+    # both branches edit merged.py and the merge commit resolves the conflict
+    _git(repo, "checkout", "-q", "-b", "side")
+    _commit(repo, ["merged.py"], "side change", "sider")
+    _git(repo, "checkout", "-q", "-")
+    _commit(repo, ["merged.py"], "main change", "mainer")
+    _git(repo, "merge", "side", author="merger", check=False)
+    with open(os.path.join(repo, "merged.py"), "w") as f:
+        f.write("resolved\n")
+    _git(repo, "add", "merged.py", author="merger")
+    _git(repo, "commit", "--no-edit", author="merger")
+    return repo
+
+
+@pytest.mark.parametrize("exclude", [None, "skip"])
+@pytest.mark.parametrize("paths_per_call", [explore.GIT_LOG_PATHS_PER_CALL, 2])
+def test_build_git_map(git_repo, monkeypatch, exclude, paths_per_call):
+    monkeypatch.setattr(explore, "GIT_LOG_PATHS_PER_CALL", paths_per_call)
+    names = ["often.py", "twice.py", "once.py", "untracked.py", "merged.py"]
+    file_paths = [os.path.join(git_repo, name) for name in names]
+    git_map = build_git_map(file_paths, exclude=exclude, root=git_repo)
+    assert git_map == {
+        file_path: _git_log_n2(git_repo, name, exclude) for file_path, name in zip(file_paths, names)
+    }
+    assert git_map[file_paths[0]].count(BLUE) == 2
+    assert git_map[file_paths[3]] == ""
+    if exclude:
+        assert "carol" not in git_map[file_paths[0]]
+    assert "merger" in git_map[file_paths[4]] and "mainer" in git_map[file_paths[4]]